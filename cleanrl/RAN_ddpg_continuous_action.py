@@ -14,21 +14,144 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from stable_baselines3.common.buffers import ReplayBuffer
+from stable_baselines3.common.type_aliases import ReplayBufferSamples
 from torch.utils.tensorboard import SummaryWriter
 
-from torch.func import functional_call, vmap, grad
-
 def l1_params(model):
-    s = 0
-    total_dims = 0
-    for p in model.parameters():
-        dims = p.size()
-        dims = np.array(dims).prod()
-        total_dims += dims
-        n = p.cpu().data.numpy().reshape(-1)
-        s += np.sum(np.abs(n))
-    return s/total_dims
+    ps = [p.detach() for p in model.parameters()]
+    total_dims = sum(p.numel() for p in ps)
+    # reduce on device and sync once, rather than once per parameter
+    return (torch.stack(torch._foreach_norm(ps, ord=1)).sum() / total_dims).item()
+
+def sample_grads(qf, x, a):
+    """
+    Forward `qf(x, a)` once, and reuse its activations for the per-sample gradients w.r.t. every parameter of `qf`,
+    in closed form
+    :param qf: (QNetwork) the network to differentiate
+    :param x: (torch.Tensor) batch of observations
+    :param a: (torch.Tensor) batch of actions
+    :return: (tuple) q-values, still attached to the autograd graph, and a list of
+        per-sample gradients of shape (batch_size, *param.shape), in the order of `qf.parameters()`
+    """
+    h0 = torch.cat([x, a], 1)
+    z1 = qf.fc1(h0)
+    h1 = F.relu(z1)
+    z2 = qf.fc2(h1)
+    h2 = F.relu(z2)
+    # q-values, and so the TD target and loss, stay in fp32 under autocast: at typical q-value scales the bf16 spacing
+    # is as large as the TD error itself
+    with torch.autocast(x.device.type, enabled=False):
+        q = qf.fc3(h2.float())
+    # the per-sample grads feed a long-horizon EMA, so they are computed in fp32, from the (possibly bf16) activations
+    with torch.no_grad(), torch.autocast(x.device.type, enabled=False):
+        h0, z1, h1, z2, h2 = (h.float() for h in (h0, z1, h1, z2, h2))
+        # backpropagate dq/dz3 = 1 by hand, keeping the batch dimension
+        dz3 = torch.ones(h2.shape[0], 1, device=h2.device)
+        dz2 = (dz3 @ qf.fc3.weight) * (z2 > 0)
+        dz1 = (dz2 @ qf.fc2.weight) * (z1 > 0)
+        grads = [
+            dz1.unsqueeze(2) * h0.unsqueeze(1),
+            dz1,
+            dz2.unsqueeze(2) * h1.unsqueeze(1),
+            dz2,
+            dz3.unsqueeze(2) * h2.unsqueeze(1),
+            dz3,
+        ]
+    return q, grads
+
+def ran_step(ms, sq_avgs, q_grads, gs, next_gs, discount, lambda_val, beta, m_lr, alpha=0.99, eps=1e-8):
+    """
+    RAN momentum update, written without in-place ops so that it can be traced by `torch.compile`
+    :param ms: (list) momentum variables, one per parameter of the Q-network
+    :param sq_avgs: (list) RMSprop running averages of the squared gradients of `ms`
+    :param q_grads: (list) gradients of the Q-network loss
+    :param gs: (list) per-sample gradients of q(s, a)
+    :param next_gs: (list) per-sample gradients of q(s', a')
+    :param discount: (torch.Tensor) per-sample gamma * (1 - done)
+    :param m_lr: (float) RMSprop learning rate of the momentum variables
+    :return: (tuple) updated momentum variables, and updated `sq_avgs`
+    """
+    ms = torch._foreach_add(torch._foreach_mul(ms, lambda_val), q_grads, alpha=beta)
+
+    # per-sample \nabla \delta = gamma * (1 - done) * \nabla q(s', a') - \nabla q(s, a), flattened to (batch_size, n_params)
+    flat_gs = torch.cat([g.flatten(1) for g in gs], dim=1)
+    flat_next_gs = torch.cat([g.flatten(1) for g in next_gs], dim=1)
+    nabla_deltas = discount.unsqueeze(1) * flat_next_gs - flat_gs
+    m_nabla_delta = nabla_deltas @ torch.cat([m.flatten() for m in ms])
+
+    # Average over the samples of (m^T \nabla \delta) \nabla \delta
+    flat_m_grads = m_nabla_delta @ nabla_deltas / nabla_deltas.shape[0]
+    m_grads = [g.view_as(m) for g, m in zip(flat_m_grads.split([m.numel() for m in ms]), ms)]
+
+    # RMSprop step on the momentum variables, same as `optim.RMSprop(m_qf1.parameters(), lr=m_lr)`
+    sq_avgs = torch._foreach_mul(sq_avgs, alpha)
+    sq_avgs = torch._foreach_addcmul(sq_avgs, m_grads, m_grads, value=1 - alpha)
+    ms = torch._foreach_addcdiv(ms, m_grads, torch._foreach_add(torch._foreach_sqrt(sq_avgs), eps), value=-m_lr)
+    return ms, sq_avgs
+
+class TensorReplayBuffer:
+    """
+    Replay buffer preallocated on `device`, so that sampling never goes through numpy or a host-to-device copy.
+    Each transition is stored as one flat row (obs, next_obs, action, reward, done) of a single tensor.
+    :param buffer_size: (int) max number of transitions in the buffer
+    :param observation_space: (gym.spaces.Box) observation space
+    :param action_space: (gym.spaces.Box) action space
+    :param device: (torch.device) device the transitions are stored and sampled on
+    :param n_envs: (int) number of parallel environments
+    :param handle_timeout_termination: (bool) do not treat timeouts (`TimeLimit.truncated`) as terminal transitions
+    """
+
+    def __init__(self, buffer_size, observation_space, action_space, device, n_envs=1, handle_timeout_termination=True):
+        assert buffer_size % n_envs == 0, "buffer_size must be a multiple of n_envs"
+        self.buffer_size = buffer_size
+        self.obs_shape = observation_space.shape
+        self.device = device
+        self.n_envs = n_envs
+        self.handle_timeout_termination = handle_timeout_termination
+        self.pos = 0
+        self.full = False
+
+        obs_dim = int(np.prod(self.obs_shape))
+        action_dim = int(np.prod(action_space.shape))
+        self.widths = [obs_dim, obs_dim, action_dim, 1, 1]
+        self.columns = np.cumsum([0] + self.widths)
+        self.storage = torch.zeros((buffer_size, sum(self.widths)), dtype=torch.float32, device=device)
+        # rows are staged in pinned memory so that the copy to `device` is asynchronous;
+        # `copy_done` makes sure a staged row is not overwritten before its copy has finished
+        use_cuda = torch.device(device).type == "cuda"
+        self.staging = torch.zeros((n_envs, sum(self.widths)), dtype=torch.float32, pin_memory=use_cuda)
+        self.copy_done = torch.cuda.Event() if use_cuda else None
+
+    def add(self, obs, next_obs, action, reward, done, infos):
+        done = np.array(done, dtype=np.float32)
+        if self.handle_timeout_termination:
+            done *= 1 - np.array([info.get("TimeLimit.truncated", False) for info in infos], dtype=np.float32)
+
+        if self.copy_done is not None:
+            self.copy_done.synchronize()
+        staging = self.staging.numpy()
+        for i, x in enumerate([obs, next_obs, action, reward, done]):
+            staging[:, self.columns[i] : self.columns[i + 1]] = np.asarray(x).reshape(self.n_envs, -1)
+        self.storage[self.pos : self.pos + self.n_envs].copy_(self.staging, non_blocking=True)
+        if self.copy_done is not None:
+            self.copy_done.record()
+
+        self.pos += self.n_envs
+        if self.pos == self.buffer_size:
+            self.full = True
+            self.pos = 0
+
+    def sample(self, batch_size):
+        upper_bound = self.buffer_size if self.full else self.pos
+        batch_inds = torch.randint(0, upper_bound, (batch_size,), device=self.device)
+        obs, next_obs, actions, rewards, dones = self.storage[batch_inds].split(self.widths, dim=1)
+        return ReplayBufferSamples(
+            observations=obs.reshape(batch_size, *self.obs_shape),
+            actions=actions,
+            next_observations=next_obs.reshape(batch_size, *self.obs_shape),
+            dones=dones,
+            rewards=rewards,
+        )
 
 def parse_args():
     # fmt: off
@@ -49,6 +172,10 @@ def parse_args():
         help="the entity (team) of wandb's project")
     parser.add_argument("--capture-video", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
         help="whether to capture videos of the agent performances (check out `videos` folder)")
+    parser.add_argument("--compile", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the networks and the RAN update will be compiled with `torch.compile`")
+    parser.add_argument("--amp", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the forward passes will run under bf16 autocast on cuda")
 
     # Algorithm specific arguments
     parser.add_argument("--env-id", type=str, default="HopperBulletEnv-v0",
@@ -158,6 +285,8 @@ if __name__ == "__main__":
     torch.backends.cudnn.deterministic = args.torch_deterministic
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    # bf16 has the dynamic range of fp32, so no GradScaler is needed; parameters and optimizer states stay in fp32
+    use_amp = args.amp and device.type == "cuda"
 
     # env setup
     envs = gym.vector.SyncVectorEnv([make_env(args.env_id, args.seed, 0, args.capture_video, run_name)])
@@ -169,8 +298,22 @@ if __name__ == "__main__":
     target_actor = Actor(envs).to(device)
     target_actor.load_state_dict(actor.state_dict())
     qf1_target.load_state_dict(qf1.state_dict())
+    # target networks are only ever updated by Polyak averaging
+    target_actor.requires_grad_(False)
+    qf1_target.requires_grad_(False)
     q_optimizer = optim.Adam(list(qf1.parameters()), lr=args.learning_rate)
     actor_optimizer = optim.Adam(list(actor.parameters()), lr=args.learning_rate)
+    actor_list = list(actor.parameters())
+    target_actor_list = list(target_actor.parameters())
+    qf1_target_list = list(qf1_target.parameters())
+    if args.compile:
+        # compiled in place so that parameter names and attributes (e.g. `actor.action_scale`) are unchanged;
+        # the compiled `qf1.forward` only serves the actor loss, the TD forwards go through `sample_grads`,
+        # which calls the submodules directly; qf1_target is never run
+        actor.compile(dynamic=False)
+        target_actor.compile(dynamic=False)
+        qf1.compile(dynamic=False)
+        sample_grads = torch.compile(sample_grads, dynamic=False)
 
     ##
     ## RAN: m_qf1 is not used for inference, it is used to hold the momentum variables
@@ -180,76 +323,84 @@ if __name__ == "__main__":
         for w in m_qf1.parameters():
             w.fill_(0)
 
-    M_optimizer = optim.RMSprop(list(m_qf1.parameters()), lr=0.5*args.learning_rate)
+    m_lr = 0.5*args.learning_rate
+    m_list = list(m_qf1.parameters())
+    q_list = list(qf1.parameters())
+    # sample_grads() returns the per-sample grads positionally, in this order
+    assert [name for name, _ in qf1.named_parameters()] == [
+        "fc1.weight", "fc1.bias", "fc2.weight", "fc2.bias", "fc3.weight", "fc3.bias"
+    ]
+    m_sq_avgs = [torch.zeros_like(m) for m in m_list]
+    if args.compile:
+        # default mode rather than "reduce-overhead": the per-sample grads and `p.grad` are freshly allocated every step,
+        # so CUDA graphs would copy them all into their static input buffers before each replay
+        ran_step = torch.compile(ran_step, fullgraph=True)
     ##
     ## END: initializing momentum to 0
     ##
 
 
-    envs.single_observation_space.dtype = np.float32
-    rb = ReplayBuffer(
+    rb = TensorReplayBuffer(
         args.buffer_size,
         envs.single_observation_space,
         envs.single_action_space,
         device,
+        n_envs=envs.num_envs,
         handle_timeout_termination=True,
     )
-    start_time = time.time()
-
-    ##
-    ## RAN: Need per=sample grads
-    ##
-
-    def compute_delta(params, observations, actions, rewards, next_observations, dones):
-        observations = observations.unsqueeze(0)
-        actions = actions.unsqueeze(0)
-        rewards = rewards.unsqueeze(0)
-        next_observations = next_observations.unsqueeze(0)
-        dones = dones.unsqueeze(0)
-        with torch.no_grad():
-            next_state_actions = target_actor(next_observations)
-        qf1_next_target = functional_call(qf1, (params,), (next_observations, next_state_actions))
-        next_q_value = rewards.flatten() + (1 - dones.flatten()) * args.gamma * (qf1_next_target).view(-1)
-        qf1_a_values = functional_call(qf1, (params,), (observations, actions)).view(-1)
-        delta_ = next_q_value - qf1_a_values
-        delta = torch.sum(delta_)
-        return delta
-
-    compute_nabla_delta = grad(compute_delta)
-    compute_sample_nabla_delta = vmap(compute_nabla_delta, in_dims=(None, 0, 0, 0, 0, 0))
 
-    ##
-    ## END
-    ##
+    # observations are staged in pinned memory, so that their copy to `device` is a plain asynchronous DMA
+    obs_pinned = torch.empty(envs.observation_space.shape, dtype=torch.float32, pin_memory=device.type == "cuda")
+    obs_gpu = torch.empty(envs.observation_space.shape, dtype=torch.float32, device=device)
+
+    # warm-up actions are drawn from the action space in large blocks rather than one `sample()` per env per step
+    action_pool_size = max(1, min(65536, int(args.learning_starts)))
+    action_pool_shape = (action_pool_size, envs.num_envs, *envs.single_action_space.shape)
+    action_pool, action_pool_idx = None, action_pool_size
+    # exploration noise is drawn into a persistent buffer, and clipped on `device` before the single copy back to the host
+    noise_std = (actor.action_scale * args.exploration_noise).detach()
+    noise_buf = torch.empty((envs.num_envs, *envs.single_action_space.shape), dtype=torch.float32, device=device)
+    action_low = torch.as_tensor(envs.single_action_space.low, dtype=torch.float32, device=device)
+    action_high = torch.as_tensor(envs.single_action_space.high, dtype=torch.float32, device=device)
+    start_time = time.time()
 
     # TRY NOT TO MODIFY: start the game
     obs = envs.reset()
     for global_step in range(args.total_timesteps):
         # ALGO LOGIC: put action logic here
         if global_step < args.learning_starts:
-            actions = np.array([envs.single_action_space.sample() for _ in range(envs.num_envs)])
+            if action_pool_idx == action_pool_size:
+                action_pool = np.random.uniform(
+                    envs.single_action_space.low, envs.single_action_space.high, action_pool_shape
+                ).astype(envs.single_action_space.dtype)
+                action_pool_idx = 0
+            actions = action_pool[action_pool_idx]
+            action_pool_idx += 1
         else:
+            # `obs_pinned` is free to overwrite, since the last `actions.cpu()` waited for its previous copy
+            obs_pinned.copy_(torch.from_numpy(obs))
+            obs_gpu.copy_(obs_pinned, non_blocking=True)
             with torch.no_grad():
-                actions = actor(torch.Tensor(obs).to(device))
-                actions += torch.normal(0, actor.action_scale * args.exploration_noise)
-                actions = actions.cpu().numpy().clip(envs.single_action_space.low, envs.single_action_space.high)
+                actions = actor(obs_gpu).addcmul_(noise_buf.normal_(), noise_std)
+                actions = torch.clamp(actions, action_low, action_high).cpu().numpy()
 
         # TRY NOT TO MODIFY: execute the game and log data.
         next_obs, rewards, dones, infos = envs.step(actions)
 
         # TRY NOT TO MODIFY: record rewards for plotting purposes
-        for info in infos:
-            if "episode" in info.keys():
-                print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
-                writer.add_scalar("charts/episodic_return", info["episode"]["r"], global_step)
-                writer.add_scalar("charts/episodic_length", info["episode"]["l"], global_step)
-                break
+        # `RecordEpisodeStatistics` only adds "episode" to the info of a done env, so only those infos are looked at
+        done_idxs = np.flatnonzero(dones)
+        if len(done_idxs) > 0:
+            info = infos[done_idxs[0]]
+            print(f"global_step={global_step}, episodic_return={info['episode']['r']}")
+            writer.add_scalar("charts/episodic_return", info["episode"]["r"], global_step)
+            writer.add_scalar("charts/episodic_length", info["episode"]["l"], global_step)
 
         # TRY NOT TO MODIFY: save data to reply buffer; handle `terminal_observation`
         real_next_obs = next_obs.copy()
-        for idx, d in enumerate(dones):
-            if d:
-                real_next_obs[idx] = infos[idx]["terminal_observation"]
+        for idx in done_idxs:
+            real_next_obs[idx] = infos[idx]["terminal_observation"]
+
         rb.add(obs, real_next_obs, actions, rewards, dones, infos)
 
         # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
@@ -259,13 +410,16 @@ if __name__ == "__main__":
 
         if global_step > args.learning_starts:
             data = rb.sample(args.batch_size)
-            with torch.no_grad():
-                next_state_actions = target_actor(data.next_observations)
-            qf1_next_target = qf1(data.next_observations, next_state_actions)
-            next_q_value = data.rewards.flatten() + (1 - data.dones.flatten()) * args.gamma * (qf1_next_target).view(-1)
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_amp):
+                with torch.inference_mode():
+                    next_state_actions = target_actor(data.next_observations)
+                # RAN: the same forward passes also give the per-sample grads
+                qf1_next_target, next_gs = sample_grads(qf1, data.next_observations, next_state_actions)
+                next_q_value = data.rewards.flatten() + (1 - data.dones.flatten()) * args.gamma * (qf1_next_target).view(-1)
 
-            qf1_a_values = qf1(data.observations, data.actions).view(-1)
-            qf1_loss = F.mse_loss(qf1_a_values, next_q_value)
+                qf1_a_values, gs = sample_grads(qf1, data.observations, data.actions)
+                qf1_a_values = qf1_a_values.view(-1)
+                qf1_loss = F.mse_loss(qf1_a_values, next_q_value)
 
             # optimize the model
             q_optimizer.zero_grad()
@@ -275,57 +429,25 @@ if __name__ == "__main__":
             ## RAN Additions
             ##
 
-            M_optimizer.zero_grad()
-
             lambda_val = 0.999
             beta = 0.001
-            clip_val = 100
 
-            for m, p in zip(m_qf1.parameters(), qf1.parameters()):
-                m.data = lambda_val*m.data + beta*p.grad
-                # m.data = lambda_val*m.data + beta*torch.clip(p.grad, min=-clip_val, max=clip_val)
-
-            q_optimizer.zero_grad()
-            M_optimizer.zero_grad()
-
-            params = {k: v.detach() for k, v in qf1.named_parameters()}
-            gs = compute_sample_nabla_delta(params, data.observations, data.actions, data.rewards, data.next_observations, data.dones)
-
-            m_nabla_delta = torch.zeros(args.batch_size).to(device)
-            for m, p in zip(m_qf1.named_parameters(), qf1.named_parameters()):
-                name = p[0]
-                m = m[1]
-                p = p[1]
-                nabla_deltas = gs[name]
-                # nabla_deltas = torch.clip(gs[name], min=-clip_val, max=clip_val)
-
-                m_ = m.unsqueeze(0)
-
-                m_nabla_delta += torch.mul(m_, nabla_deltas).reshape(args.batch_size, -1).sum(1)
-
-            for m, p in zip(m_qf1.named_parameters(), qf1.named_parameters()):
-                name = p[0]
-                m = m[1]
-                p = p[1]
-                nabla_deltas = gs[name]
-                # nabla_deltas = torch.clip(gs[name], min=-clip_val, max=clip_val)
-
-                if len(p.shape) == 2:
-                    m_nabla_delta_ = m_nabla_delta.reshape(-1, 1, 1)
-                elif len(p.shape) == 1:
-                    m_nabla_delta_ = m_nabla_delta.reshape(-1, 1)
-
-                m_nabla_delta_nabla_delta = torch.mul(m_nabla_delta_, nabla_deltas).mean(0) # Average over the samples of (m^T \nabla \delta) \nabla \delta
-
-                # m.grad = torch.clip(m_nabla_delta_nabla_delta, min=-clip_val, max=clip_val) # let M be updated with its own optimizer
-                m.grad = m_nabla_delta_nabla_delta # let M be updated with its own optimizer
-                # m.data = m - beta*m_nabla_delta_nabla_delta
-
-            M_optimizer.step() # Does nothing, unless m.grad is set
-
-            for m, p in zip(m_qf1.parameters(), qf1.parameters()):
-                p.grad = m.data # let q be updated with its own optimizer
-                # p.grad = torch.clip(m.data, min=-clip_val, max=clip_val) # let q be updated with its own optimizer
+            with torch.no_grad():
+                ms, sq_avgs = ran_step(
+                    m_list,
+                    m_sq_avgs,
+                    [p.grad for p in q_list],
+                    gs,
+                    next_gs,
+                    args.gamma * (1 - data.dones.flatten()),
+                    lambda_val,
+                    beta,
+                    m_lr,
+                )
+                torch._foreach_copy_(m_list, ms)
+                torch._foreach_copy_(m_sq_avgs, sq_avgs)
+                # let q be updated with its own optimizer
+                torch._foreach_copy_([p.grad for p in q_list], ms)
 
             ##
             ## END
@@ -334,16 +456,16 @@ if __name__ == "__main__":
             q_optimizer.step()
 
             if global_step % args.policy_frequency == 0:
-                actor_loss = -qf1(data.observations, actor(data.observations)).mean()
+                with torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_amp):
+                    actor_loss = -qf1(data.observations, actor(data.observations)).mean()
                 actor_optimizer.zero_grad()
                 actor_loss.backward()
                 actor_optimizer.step()
 
                 # update the target network
-                for param, target_param in zip(actor.parameters(), target_actor.parameters()):
-                    target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
-                for param, target_param in zip(qf1.parameters(), qf1_target.parameters()):
-                    target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
+                with torch.no_grad():
+                    torch._foreach_lerp_(target_actor_list, actor_list, args.tau)
+                    torch._foreach_lerp_(qf1_target_list, q_list, args.tau)
 
             if global_step % 100 == 0:
                 writer.add_scalar("losses/qf1_loss", qf1_loss.item(), global_step)
@@ -0,0 +1,50 @@
+import gym
+import numpy as np
+import torch
+
+from cleanrl.RAN_ddpg_continuous_action import TensorReplayBuffer
+
+
+def test_tensor_replay_buffer():
+    """
+    Test `TensorReplayBuffer` on cpu: timeout masking of `done`, wrap-around, and the columns returned by `sample`
+    """
+    n_envs = 2
+    observation_space = gym.spaces.Box(-np.inf, np.inf, (3,), dtype=np.float32)
+    action_space = gym.spaces.Box(-1.0, 1.0, (2,), dtype=np.float32)
+    rb = TensorReplayBuffer(4, observation_space, action_space, "cpu", n_envs=n_envs, handle_timeout_termination=True)
+
+    def add(k, dones, infos):
+        # every column of transition k is a function of k, so sampled rows can be checked for consistency
+        obs = np.full((n_envs, 3), k, dtype=np.float32)
+        rb.add(obs, obs + 0.5, np.full((n_envs, 2), -k, dtype=np.float32), np.full(n_envs, 10 * k), dones, infos)
+
+    # a timeout is not a terminal transition, a real termination is
+    add(1, [True, True], [{"TimeLimit.truncated": True}, {}])
+    dones = rb.storage[:2, rb.columns[4] : rb.columns[5]]
+    assert dones.flatten().tolist() == [0.0, 1.0]
+    assert rb.pos == 2 and not rb.full
+
+    add(2, [False, False], [{}, {}])
+    assert rb.pos == 0 and rb.full
+
+    # once full, the oldest rows are overwritten
+    add(3, [False, False], [{}, {}])
+    assert rb.pos == 2 and rb.full
+    obs = rb.storage[:, rb.columns[0] : rb.columns[1]]
+    assert obs[:, 0].tolist() == [3.0, 3.0, 2.0, 2.0]
+
+    batch_size = 64
+    data = rb.sample(batch_size)
+    assert data.observations.shape == (batch_size, 3)
+    assert data.next_observations.shape == (batch_size, 3)
+    assert data.actions.shape == (batch_size, 2)
+    assert data.rewards.shape == (batch_size, 1)
+    assert data.dones.shape == (batch_size, 1)
+    k = data.observations[:, :1]
+    assert set(k.flatten().tolist()) <= {2.0, 3.0}
+    torch.testing.assert_close(data.observations, k.expand(-1, 3))
+    torch.testing.assert_close(data.next_observations, k.expand(-1, 3) + 0.5)
+    torch.testing.assert_close(data.actions, -k.expand(-1, 2))
+    torch.testing.assert_close(data.rewards, 10 * k)
+    torch.testing.assert_close(data.dones, torch.zeros(batch_size, 1))
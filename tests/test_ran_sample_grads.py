@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import gym
+import numpy as np
+import torch
+from torch.func import functional_call, grad, vmap
+
+from cleanrl.RAN_ddpg_continuous_action import QNetwork, sample_grads
+
+
+def test_sample_grads():
+    """
+    Test the closed-form per-sample gradients of `sample_grads` against `vmap(grad(functional_call(...)))`
+    """
+    batch_size = 32
+    gamma = 0.99
+    torch.manual_seed(42)
+    envs = SimpleNamespace(
+        single_observation_space=gym.spaces.Box(-np.inf, np.inf, (11,), dtype=np.float32),
+        single_action_space=gym.spaces.Box(-1.0, 1.0, (3,), dtype=np.float32),
+    )
+    qf = QNetwork(envs)
+    params = {k: v.detach() for k, v in qf.named_parameters()}
+
+    def compute_q(params, x, a):
+        return functional_call(qf, (params,), (x.unsqueeze(0), a.unsqueeze(0))).squeeze()
+
+    compute_sample_grads = vmap(grad(compute_q), in_dims=(None, 0, 0))
+
+    def compute_delta(params, x, a, reward, next_x, next_a, done):
+        next_q = functional_call(qf, (params,), (next_x.unsqueeze(0), next_a.unsqueeze(0))).view(-1)
+        q = functional_call(qf, (params,), (x.unsqueeze(0), a.unsqueeze(0))).view(-1)
+        return torch.sum(reward + (1 - done) * gamma * next_q - q)
+
+    compute_sample_nabla_delta = vmap(grad(compute_delta), in_dims=(None, 0, 0, 0, 0, 0, 0))
+
+    observations = torch.randn(batch_size, 11)
+    actions = torch.rand(batch_size, 3) * 2 - 1
+    next_observations = torch.randn(batch_size, 11)
+    next_actions = torch.rand(batch_size, 3) * 2 - 1
+    rewards = torch.randn(batch_size)
+    dones = torch.randint(0, 2, (batch_size,)).float()
+
+    q, gs = sample_grads(qf, observations, actions)
+    next_q, next_gs = sample_grads(qf, next_observations, next_actions)
+    ref_gs = compute_sample_grads(params, observations, actions)
+    ref_next_gs = compute_sample_grads(params, next_observations, next_actions)
+    ref_nabla_deltas = compute_sample_nabla_delta(
+        params, observations, actions, rewards, next_observations, next_actions, dones
+    )
+    # the per-sample discount exactly as it is passed to `ran_step`
+    discount = gamma * (1 - dones)
+
+    torch.testing.assert_close(q, qf(observations, actions))
+    torch.testing.assert_close(next_q, qf(next_observations, next_actions))
+    assert len(gs) == len(params)
+    for name, g, next_g in zip(params, gs, next_gs):
+        torch.testing.assert_close(g, ref_gs[name])
+        torch.testing.assert_close(next_g, ref_next_gs[name])
+        # `ran_step` combines them into \nabla \delta of the TD error r + gamma * (1 - done) * q(s', a') - q(s, a)
+        nabla_delta = discount.view(-1, *[1] * (g.dim() - 1)) * next_g - g
+        torch.testing.assert_close(nabla_delta, ref_nabla_deltas[name])
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import gym
+import numpy as np
+import torch
+import torch.optim as optim
+
+from cleanrl.RAN_ddpg_continuous_action import QNetwork, ran_step
+
+
+def test_ran_step():
+    """
+    Test `ran_step` against the per-parameter RAN loops followed by `optim.RMSprop(...).step()`
+    """
+    batch_size = 32
+    num_steps = 5
+    gamma = 0.99
+    lambda_val = 0.999
+    beta = 0.001
+    m_lr = 1.5e-4
+    torch.manual_seed(42)
+    envs = SimpleNamespace(
+        single_observation_space=gym.spaces.Box(-np.inf, np.inf, (11,), dtype=np.float32),
+        single_action_space=gym.spaces.Box(-1.0, 1.0, (3,), dtype=np.float32),
+    )
+    # float64, so that the two summation orders agree to tight tolerances
+    m_qf1 = QNetwork(envs).double()
+    with torch.no_grad():
+        for w in m_qf1.parameters():
+            w.fill_(0)
+    M_optimizer = optim.RMSprop(list(m_qf1.parameters()), lr=m_lr)
+    ms = [torch.zeros_like(m) for m in m_qf1.parameters()]
+    sq_avgs = [torch.zeros_like(m) for m in m_qf1.parameters()]
+
+    for _ in range(num_steps):
+        q_grads = [torch.randn_like(m) for m in m_qf1.parameters()]
+        gs = [torch.randn(batch_size, *m.shape, dtype=m.dtype) for m in m_qf1.parameters()]
+        next_gs = [torch.randn(batch_size, *m.shape, dtype=m.dtype) for m in m_qf1.parameters()]
+        dones = torch.randint(0, 2, (batch_size,)).double()
+        discount = gamma * (1 - dones)
+
+        with torch.no_grad():
+            for m, g in zip(m_qf1.parameters(), q_grads):
+                m.data = lambda_val * m.data + beta * g
+            nabla_deltas = [discount.view(-1, *[1] * (g.dim() - 1)) * next_g - g for g, next_g in zip(gs, next_gs)]
+            m_nabla_delta = torch.zeros(batch_size, dtype=torch.float64)
+            for m, nabla_delta in zip(m_qf1.parameters(), nabla_deltas):
+                m_nabla_delta += torch.mul(m.unsqueeze(0), nabla_delta).reshape(batch_size, -1).sum(1)
+            for m, nabla_delta in zip(m_qf1.parameters(), nabla_deltas):
+                if len(m.shape) == 2:
+                    m_nabla_delta_ = m_nabla_delta.reshape(-1, 1, 1)
+                elif len(m.shape) == 1:
+                    m_nabla_delta_ = m_nabla_delta.reshape(-1, 1)
+                m.grad = torch.mul(m_nabla_delta_, nabla_delta).mean(0)
+        M_optimizer.step()
+
+        ms, sq_avgs = ran_step(ms, sq_avgs, q_grads, gs, next_gs, discount, lambda_val, beta, m_lr)
+
+        for m, m_ref in zip(ms, m_qf1.parameters()):
+            torch.testing.assert_close(m, m_ref.detach())
+        for sq_avg, m_ref in zip(sq_avgs, m_qf1.parameters()):
+            torch.testing.assert_close(sq_avg, M_optimizer.state[m_ref]["square_avg"])